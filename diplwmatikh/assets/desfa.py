@@ -1,34 +1,163 @@
-from functools import reduce
+import json
+import os
+import re
+import tempfile
+from contextlib import contextmanager
 from io import BytesIO
+from typing import Optional, Tuple
 
 import pandas as pd
 import numpy as np
-import pytz
 import requests
 import datetime
-from entsog import EntsogRawClient, EntsogPandasClient
-from entsoe import EntsoeRawClient, EntsoePandasClient
-from entsoe.exceptions import NoMatchingDataError
-from pandas import Timestamp
-from pandas.core.indexes.datetimes import DatetimeIndex
+from openpyxl import load_workbook
+from entsoe import EntsoePandasClient
 
-from ..utils import entsoe_utils, entsog_utils
-from ..utils.entsoe_utils import transform_columns_to_ids
-from ..utils.common import sanitize_series, sanitize_df, timewindow_to_ts, replace_dash_with_nan
+from ..utils.common import timewindow_to_ts, replace_dash_with_nan, http_session
 
 from dagster import (
-    AssetKey,
-    DagsterInstance,
-    MetadataValue,
     Output,
     asset,
-    get_dagster_logger,
     StaticPartitionsDefinition,
     MonthlyPartitionsDefinition,
-    AssetExecutionContext, EnvVar, TimeWindow
+    AssetExecutionContext, EnvVar
 )
 
 entry_points = ["AGIA TRIADA", "SIDIROKASTRO", "KIPI", "NEA MESIMVRIA"]
+ng_quality_columns = ["c1", "c2", "c3", "i_c4", "n_c4", "i_c5", "n_c5", "neo_c5", "c6_plus", "n2", "co2",
+                      "gross_heating_value", "wobbe_index", "water_dew_point", "hydrocarbon_dew_point_max"]
+
+# Shared session for all DESFA downloads (connection reuse across assets/runs in the same process)
+_SESSION = http_session()
+
+
+# Stream the body of a (stream=True) response to a temporary file in chunks, instead of buffering it in memory.
+# Yields the path of the file, which is deleted on exit.
+@contextmanager
+def _streamed_to_tempfile(response: requests.Response, suffix: Optional[str] = None):
+    tmp = tempfile.NamedTemporaryFile(suffix=suffix, delete=False)
+    try:
+        # Written inside the try, so that a partial download (e.g. a timeout mid-stream) is removed as well
+        with tmp:
+            for chunk in response.iter_content(chunk_size=1 << 16):
+                tmp.write(chunk)
+        yield tmp.name
+    finally:
+        os.remove(tmp.name)
+
+
+# Read a worksheet of an .xlsx file into a DataFrame straight from openpyxl's read-only row iterator,
+# skipping pandas' Excel parser. Mirrors pd.read_excel(..., sheet_name=sheet_index): the first sheet row is
+# treated as the header row and dropped, trailing empty rows/columns are trimmed. Columns are left positional.
+def _read_xlsx_fast(path: str, sheet_index: int = 0) -> pd.DataFrame:
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        ws = wb.worksheets[sheet_index]
+        ws.reset_dimensions()  # Stored dimensions of read-only sheets are not always reliable
+        rows = list(ws.iter_rows(values_only=True))
+    finally:
+        wb.close()
+
+    df = pd.DataFrame(rows)
+    # Trim trailing empty rows and columns, then drop the header row
+    present = df.notna()
+    last_row = present.any(axis=1).to_numpy().nonzero()[0].max(initial=0)
+    last_col = present.any(axis=0).to_numpy().nonzero()[0].max(initial=0)
+    df = df.iloc[1:last_row + 1, :last_col + 1].reset_index(drop=True)
+    return df
+
+
+# Transform a wide DESFA sheet (first row: point names, first column: timestamps) to long format, indexed by
+# (timestamp, point_id, point_type). The first `n_entry` points are entry points and the rest exit points,
+# since a point may be bidirectional. The index is built directly from the factorized header/timestamp codes,
+# without melting or materializing a string per row.
+def _points_wide_to_long(df: pd.DataFrame, n_entry: int = 4) -> pd.DataFrame:
+    point_ids = df.iloc[0, 1:].tolist()
+    point_types = ["entry"] * n_entry + ["exit"] * (len(point_ids) - n_entry)
+
+    df = df.iloc[1:]  # Drop the header row
+    timestamps = pd.to_datetime(df.iloc[:, 0], format='%Y')
+    values = df.iloc[:, 1:].to_numpy()
+    n_rows, n_cols = values.shape
+
+    ts_codes, ts_levels = pd.factorize(timestamps)
+    pid_codes, pid_levels = pd.factorize(np.array(point_ids, dtype=object))
+    pt_codes, pt_levels = pd.factorize(np.array(point_types, dtype=object))
+    index = pd.MultiIndex(levels=[ts_levels, pid_levels, pt_levels],
+                          codes=[np.repeat(ts_codes, n_cols), np.tile(pid_codes, n_rows), np.tile(pt_codes, n_rows)],
+                          names=['timestamp', 'point_id', 'point_type'])
+    return pd.DataFrame({'value': values.ravel()}, index=index)
+
+
+# Directory where the parsed DataFrames of the static DESFA files are cached between runs, along with the
+# validators (ETag/Last-Modified) of the downloaded file they were parsed from. The cached DataFrames are pickles,
+# so the directory must be private to this user (never a shared location such as /tmp).
+_CACHE_DIR = os.environ.get("DESFA_CACHE_DIR") or os.path.join(
+    os.environ.get("DAGSTER_HOME") or os.path.join(os.path.expanduser("~"), ".cache", "diplwmatikh"), "desfa_cache")
+# Version of the parsing of the cached assets, part of the cache file names.
+# Bump it whenever their parsing or output layout changes, so that DataFrames cached by older code are not reused.
+_CACHE_VERSION = 1
+
+
+def _cache_paths(url: str) -> Tuple[str, str]:
+    name = f"{url.rsplit('/', 1)[-1]}.v{_CACHE_VERSION}"
+    return os.path.join(_CACHE_DIR, f"{name}.pkl"), os.path.join(_CACHE_DIR, f"{name}.json")
+
+
+# The cache is only trusted if its directory is owned by the current user and not writable by anyone else
+def _cache_dir_is_private() -> bool:
+    try:
+        stat = os.stat(_CACHE_DIR)
+    except FileNotFoundError:
+        return False
+    return stat.st_uid == os.getuid() and not stat.st_mode & 0o022
+
+
+# Send a conditional GET for `url`, using the validators stored with the cached DataFrame (if any).
+# Returns the cached DataFrame if the server reports the file as unchanged (HTTP 304), otherwise None,
+# along with the response itself.
+def _conditional_get(url: str, **kwargs) -> Tuple[Optional[pd.DataFrame], requests.Response]:
+    data_path, validators_path = _cache_paths(url)
+    headers = {}
+    if _cache_dir_is_private() and os.path.exists(data_path) and os.path.exists(validators_path):
+        with open(validators_path) as f:
+            validators = json.load(f)
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+
+    response = _SESSION.get(url, headers=headers, **kwargs)
+    if response.status_code == 304:
+        try:
+            return pd.read_pickle(data_path), response
+        except Exception:
+            # Unreadable cache (e.g. written by another pandas version), fetch the file unconditionally
+            response.close()
+            response = _SESSION.get(url, **kwargs)
+    return None, response
+
+
+# Store the DataFrame parsed from a (200) response, along with the response's validators
+def _update_cache(url: str, response: requests.Response, df: pd.DataFrame):
+    validators = {"etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified")}
+    if not any(validators.values()):
+        return  # The file cannot be revalidated, so there is no point in caching it
+    data_path, validators_path = _cache_paths(url)
+    os.makedirs(_CACHE_DIR, mode=0o700, exist_ok=True)
+    if not _cache_dir_is_private():
+        return  # Never write pickles to a directory others can tamper with
+    df.to_pickle(data_path)
+    # Written last, so that an interrupted update never pairs new validators with stale data
+    with open(validators_path, "w") as f:
+        json.dump(validators, f)
+
+
+# Output metadata recording which version of the remote file the data was parsed from
+def _cache_metadata(response: requests.Response) -> dict:
+    return {key: response.headers[header] for key, header in [("etag", "ETag"), ("last_modified", "Last-Modified")]
+            if header in response.headers}
+
 
 # DESFA assets
 
@@ -42,66 +171,27 @@ entry_points = ["AGIA TRIADA", "SIDIROKASTRO", "KIPI", "NEA MESIMVRIA"]
 def desfa_flows_daily(context: AssetExecutionContext):
     url = 'https://www.desfa.gr/userfiles/pdflist/DDRA/Flows.xlsx'
 
-    # Fetch the content of the .xls file
-    response = requests.get(url)
-    dataframes = {}
+    # Fetch the .xlsx file (unless unchanged since the last run), streaming its content
+    cached, response = _conditional_get(url, stream=True, timeout=60)
+    if cached is not None:
+        context.log.info("File unchanged since the last run, reusing the cached data.")
+        response.close()  # Streamed, so the connection is only released once closed (or its body is consumed)
+        return Output(value=cached, metadata=_cache_metadata(response))
     # Check if the request was successful
     if response.status_code == 200:
-        # Use BytesIO to create a file-like object from the content
-        file_content = BytesIO(response.content)
-        df = pd.read_excel(file_content, sheet_name=0)
+        with _streamed_to_tempfile(response, suffix='.xlsx') as path:
+            df = _read_xlsx_fast(path)
 
         df = df.drop(df.columns[5], axis=1)  # Remove 5th column starting from 0 (empty)
         df = df.drop(df.index[0:3])  # Remove first 3 rows (not needed for data)
         df = df[~df.iloc[:, 0].astype(str).str.contains('ΣΥΝΟΛΟ')]  # Remove lines that contain aggregates
 
-        # Now to transform the dataframe to make the first row (barring the first element) into an index
-
-        new_headers = df.iloc[0, 1:].tolist()
-        # Adding suffix "_exit" to the first 4 headers and "_entry" to the rest, since a point may be bidirectional
-        new_headers = [x + "_entry" for x in new_headers[:4]] + [x + "_exit" for x in new_headers[4:]]
-
-        # We will remove the suffixes later
-        def remove_suffix(point: str):
-            if point.endswith("_entry"):
-                return point[:-6]
-            else:
-                return point[:-5]
-
-        df.columns = ['timestamp'] + new_headers  # Keep 'timestamp' for the first column and update the rest
-        # Drop the first row
-        df = df.drop(df.index[0])
-        # Reset index if necessary
-        df.reset_index(drop=True, inplace=True)
-
-        df['timestamp'] = pd.to_datetime(df['timestamp'], format='%Y')
-
-        # Melt the DataFrame to go from wide to long format
-        df_long = pd.melt(df, id_vars=['timestamp'], var_name='point_id', value_name='value')
-
-        # Set the new index using the 'timestamp' and 'point_id' columns to create a MultiIndex
-        df_long.set_index(['timestamp', 'point_id'], inplace=True)
-
-        # Now, to add "entry"/"exit" labels to our points
-        def label_point_as_entry_or_exit(point: str):
-            if point.endswith("_entry"):
-                return "entry"
-            else:
-                return "exit"
-
-        # Apply this function to the 'point_id' index level
-        processed_header = df_long.index.get_level_values('point_id').map(label_point_as_entry_or_exit)
-        # Add the processed values as a new level to the index
-        df_long['point_type'] = processed_header
-        # Then set this new column as an additional level of the index
-        df_long.set_index('point_type', append=True, inplace=True)
-
-        df_long.reset_index(drop=False, inplace=True)
-        df_long['point_id'] = df_long['point_id'].apply(remove_suffix)
-
-        df_long.set_index(['timestamp', 'point_id', 'point_type'], inplace=True)
-        return Output(value=df_long)
+        df_long = _points_wide_to_long(df)
+        df_long['value'] = pd.to_numeric(df_long['value'], errors='coerce').astype(np.float64)
+        _update_cache(url, response, df_long)
+        return Output(value=df_long, metadata=_cache_metadata(response))
     else:
+        response.close()
         raise Exception(f"Failed to fetch the file, status code: {response.status_code}")
 
 
@@ -137,8 +227,11 @@ def desfa_ng_quality_yearly(context: AssetExecutionContext):
 
     url = 'https://www.desfa.gr/userfiles/pdflist/DDRA/NG-QUALITY.xls'
 
-    # Fetch the content of the .xls file
-    response = requests.get(url)
+    # Fetch the content of the .xls file (unless unchanged since the last run)
+    cached, response = _conditional_get(url, timeout=30)
+    if cached is not None:
+        context.log.info("File unchanged since the last run, reusing the cached data.")
+        return Output(value=cached, metadata=_cache_metadata(response))
     dataframes = {}
     # Check if the request was successful
     if response.status_code == 200:
@@ -146,14 +239,19 @@ def desfa_ng_quality_yearly(context: AssetExecutionContext):
         file_content = BytesIO(response.content)
         full_df = pd.read_excel(file_content, sheet_name=0)
 
+        # Locate the "Entry Point: <name>" label rows in one vectorized pass over all columns,
+        # keeping the first row each entry point appears in
+        label_pattern = "Entry Point: (" + "|".join(re.escape(point) for point in entry_points) + ")"
+        matches = full_df.astype("string").apply(lambda col: col.str.extract(label_pattern, expand=False))
+        matches = matches.bfill(axis=1).iloc[:, 0].dropna().drop_duplicates()
+        entry_to_row = {name: row_idx for row_idx, name in zip(matches.index, matches)}
+
+        current_year = datetime.date.today().year
         for search_string in entry_points:
             # Find the row index for the search string
             start_row = None
-            current_year = datetime.date.today().year
-            for row_idx in range(len(full_df)):
-                if f"Entry Point: {search_string}" in full_df.iloc[row_idx].to_string():
-                    start_row = row_idx + 3  # Start from the row 3 rows below the found search string
-                    break
+            if search_string in entry_to_row:
+                start_row = entry_to_row[search_string] + 3  # Start from the row 3 rows below the found search string
             if start_row is not None:
                 # Assuming the DataFrame has enough rows and columns, adjust as necessary
                 # Nea mesimvria has data from 2021, the rest from 2008
@@ -162,23 +260,24 @@ def desfa_ng_quality_yearly(context: AssetExecutionContext):
                 else:
                     end_row = min(start_row + (current_year - 2008) + 1, len(full_df))  # To not go beyond the DataFrame
                 # Assuming we want the first 16 columns, adjust the slicing as necessary
-                block = full_df.iloc[start_row:end_row, :16].copy()
-
-                block.columns = ["timestamp", "c1", "c2", "c3", "i_c4", "n_c4", "i_c5", "n_c5", "neo_c5",
-                                 "c6_plus", "n2", "co2", "gross_heating_value", "wobbe_index", "water_dew_point",
-                                 "hydrocarbon_dew_point_max"]
+                values = full_df.iloc[start_row:end_row, :16].to_numpy()
 
                 # Convert the 'Year' column to datetime format, ensuring it starts on Jan 1st at 00:00
-                block['timestamp'] = pd.to_datetime(block['timestamp'], format='%Y')
-                # Set the 'timestamp' column as the index of the DataFrame
-                block.set_index('timestamp', inplace=True)
-                # Ensure the index is timezone-naive
-                block.index = block.index.tz_localize(None)
+                # (built directly as numpy years since the epoch, instead of strptime-parsing each cell)
+                # Blank year cells (e.g. rows past the data of the current year) become NaT, as with pd.to_datetime
+                years = pd.to_numeric(values[:, 0], errors='raise')
+                missing = pd.isna(years)
+                timestamps = np.full(len(years), np.datetime64('NaT'), dtype='datetime64[ns]')
+                timestamps[~missing] = (years[~missing].astype(np.int64) - 1970).astype('datetime64[Y]')
+                timestamps = pd.DatetimeIndex(timestamps, name='timestamp')
+
+                # Build the block in a single allocation, indexed by the (timezone-naive) timestamps
+                block = pd.DataFrame(values[:, 1:], columns=ng_quality_columns, index=timestamps)
                 # Insert point_id column at start
                 block.insert(0, 'point_id', search_string)
 
-                # Apply the function to remove dashes each cell of the DataFrame
-                block = block.map(replace_dash_with_nan)
+                # Replace cells containing only dashes with NaN
+                block = replace_dash_with_nan(block)
 
                 # Replace "<" prefix in the specific columns (if not NaN, in which case dtype is np.float64)
                 if block["hydrocarbon_dew_point_max"].dtype == object:
@@ -196,8 +295,9 @@ def desfa_ng_quality_yearly(context: AssetExecutionContext):
 
     dataframe = pd.concat(dataframes.values())
     dataframe.set_index("point_id", inplace=True, append=True)
+    _update_cache(url, response, dataframe)
 
-    return Output(value=dataframe)
+    return Output(value=dataframe, metadata=_cache_metadata(response))
 
 
 @asset(
@@ -213,7 +313,7 @@ def desfa_ng_pressure_monthly(context: AssetExecutionContext):
     url = 'https://www.desfa.gr/userfiles/pdflist/DDRA/NG-Pressure.xls'
 
     # Fetch the content of the .xls file
-    response = requests.get(url)
+    response = _SESSION.get(url, timeout=30)
     # Check if the request was successful
     if response.status_code == 200:
         # Use BytesIO to create a file-like object from the content
@@ -306,13 +406,16 @@ def desfa_ng_gcv_daily(context: AssetExecutionContext):
 
     url = 'https://www.desfa.gr/userfiles/pdflist/DDRA/GCV.xlsx'
 
-    # Fetch the content of the .xls file
-    response = requests.get(url)
+    # Fetch the .xlsx file (unless unchanged since the last run), streaming its content
+    cached, response = _conditional_get(url, stream=True, timeout=60)
+    if cached is not None:
+        context.log.info("File unchanged since the last run, reusing the cached data.")
+        response.close()  # Streamed, so the connection is only released once closed (or its body is consumed)
+        return Output(value=cached, metadata=_cache_metadata(response))
     # Check if the request was successful
     if response.status_code == 200:
-        # Use BytesIO to create a file-like object from the content
-        file_content = BytesIO(response.content)
-        df = pd.read_excel(file_content, sheet_name=0)
+        with _streamed_to_tempfile(response, suffix='.xlsx') as path:
+            df = _read_xlsx_fast(path)
 
         df = df.drop(df.columns[5], axis=1)  # Remove 5th column starting from 0 (empty)
 
@@ -320,58 +423,13 @@ def desfa_ng_gcv_daily(context: AssetExecutionContext):
         df = df.iloc[:, :-1]  # This selects all rows and all columns except the last one
         df = df.iloc[:-4, :]  # This selects all columns and all rows except the last 4 rows
 
-        # Now we've dropped all the excess rows and columns.
-        # Time to transform the dataframe to make the first row (barring the first element) into an index
-
-        new_headers = df.iloc[0, 1:].tolist()
-        # Adding suffix "_exit" to the first 4 headers and "_entry" to the rest, since a point may be bidirectional
-        new_headers = [x + "_entry" for x in new_headers[:4]] + [x + "_exit" for x in new_headers[4:]]
-        print(new_headers)
-
-        # We will remove the suffixes later
-        def remove_suffix(point: str):
-            if point.endswith("_entry"):
-                return point[:-6]
-            else:
-                return point[:-5]
-
-        df.columns = ['timestamp'] + new_headers  # Keep 'timestamp' for the first column and update the rest
-        # Drop the first row
-        df = df.drop(df.index[0])
-        # Reset index if necessary
-        df.reset_index(drop=True, inplace=True)
-
-        df['timestamp'] = pd.to_datetime(df['timestamp'], format='%Y')
-
-        # Melt the DataFrame to go from wide to long format
-        df_long = pd.melt(df, id_vars=['timestamp'], var_name='point_id', value_name='value')
-
-        # Set the new index using the 'timestamp' and 'point_id' columns to create a MultiIndex
-        df_long.set_index(['timestamp', 'point_id'], inplace=True)
-
-        # Now, to add "entry"/"exit" labels to our points
-        def label_point_as_entry_or_exit(point: str):
-            if point.endswith("_entry"):
-                return "entry"
-            else:
-                return "exit"
-
-        # Apply this function to the 'point_id' index level
-        processed_header = df_long.index.get_level_values('point_id').map(label_point_as_entry_or_exit)
-        # Add the processed values as a new level to the index
-        df_long['point_type'] = processed_header
-        # Then set this new column as an additional level of the index
-        df_long.set_index('point_type', append=True, inplace=True)
-
-        # Applying reverse transformation to the 'point_id' index, i.e. removing suffix
-        df_long.reset_index(drop=False, inplace=True)
-        df_long['point_id'] = df_long['point_id'].apply(remove_suffix)
-
-        df_long.set_index(['timestamp', 'point_id', 'point_type'], inplace=True)
-
-        df_long = df_long.map(replace_dash_with_nan)
-        return Output(value=df_long)
+        df_long = _points_wide_to_long(df)
+        df_long['value'] = replace_dash_with_nan(df_long['value'])
+        df_long['value'] = pd.to_numeric(df_long['value'], errors='coerce').astype(np.float64)
+        _update_cache(url, response, df_long)
+        return Output(value=df_long, metadata=_cache_metadata(response))
     else:
+        response.close()
         raise Exception(f"Failed to fetch the file, status code: {response.status_code}")
 
 
@@ -407,7 +465,7 @@ def desfa_estimated_vs_actual_offtakes(context: AssetExecutionContext):
     url = 'https://www.desfa.gr/userfiles/pdflist/DDRA/Off_Takes_Estimation.xlsx'
 
     # Fetch the content of the .xls file
-    response = requests.get(url)
+    response = _SESSION.get(url, timeout=30)
     # Check if the request was successful
     if response.status_code == 200:
         # Use BytesIO to create a file-like object from the content
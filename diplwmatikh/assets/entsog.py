@@ -1,234 +1,162 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+import numpy as np
 import pandas as pd
+import requests
+from pandas.api.types import union_categoricals
 from dagster import (
     Output,
     asset,
     MonthlyPartitionsDefinition,
     AssetExecutionContext
 )
+from entsog.exceptions import GatewayTimeOut
 
 from ..utils import entsog_utils
-from ..utils.common import sanitize_df, timewindow_to_ts
+from ..utils.common import timewindow_to_ts
+
+
+# Maximum number of concurrent ENTSOG API requests per asset run
+_MAX_WORKERS = 8
+
+
+# Days covered by a single request. A window whose request times out is split in two and each half is retried,
+# down to windows of two days (a single day returns no data).
+_WINDOW_DAYS = 7
+_MIN_WINDOW_DAYS = 2
+
+# Read timeout (seconds) of a request for a window that can still be split. Shorter than the default of
+# entsog_utils, so that a window too large to serve in time is split early rather than waited on.
+_SPLITTABLE_TIMEOUT = 60
+
+# Errors caused by the requested window being too large to serve in time; any other error is re-raised as is
+_TIMEOUT_ERRORS = (requests.Timeout, GatewayTimeOut)
+
+
+# Fetch and clean the data of the window from `window_start` to `window_end` (inclusive).
+# Returns the cleaned chunks, none when no matching data is found.
+def _fetch_window(window_start: pd.Timestamp, window_end: pd.Timestamp, indicator: str, keys: List[str],
+                  context: AssetExecutionContext) -> List[pd.DataFrame]:
+    window_days = (window_end - window_start).days + 1
+    splittable = window_days >= 2 * _MIN_WINDOW_DAYS
+    try:
+        # Windows that can still be split are given up on sooner, narrower windows are tried instead
+        if splittable:
+            data = entsog_utils.entsog_api_call_with_retries(window_start, window_end, [indicator], keys, context,
+                                                             max_retries=2, timeout=_SPLITTABLE_TIMEOUT)
+        else:
+            data = entsog_utils.entsog_api_call_with_retries(window_start, window_end, [indicator], keys, context)
+    except _TIMEOUT_ERRORS as e:
+        if not splittable:
+            raise
+        middle = window_start + pd.Timedelta(days=window_days // 2)
+        context.log.info(f"Request from {window_start.strftime('%Y-%m-%d')} to {window_end.strftime('%Y-%m-%d')} "
+                         f"failed with {type(e).__name__}, splitting it in two.")
+        return (_fetch_window(window_start, middle - pd.Timedelta(days=1), indicator, keys, context)
+                + _fetch_window(middle, window_end, indicator, keys, context))
+
+    if data.empty:  # Happens when no matching data is found
+        return []
+    context.log.info(f"Fetched data from {window_start.strftime('%Y-%m-%d')} to {window_end.strftime('%Y-%m-%d')}")
+    data = entsog_utils.label_potential_duplicates_with_tso(data)
+    return [_clean_chunk(data)]
+
+
+# Rename columns to more applicable names
+_RENAME = {"direction_key": "point_type", "period_from": "timestamp", "point_label": "point_id"}
+
+
+# Keep only the rows that have a value (neither None nor an empty string) and the primary key columns
+# (timestamp, point_id, point_type), with the timestamp sanitized to UTC/tz-naive.
+# point_id and point_type have very few distinct values, so they are kept as categoricals.
+# The index is not set here but once for all chunks, see _combine_chunks.
+def _clean_chunk(data: pd.DataFrame) -> pd.DataFrame:
+    data = data.rename(columns=_RENAME)
+    mask = data['value'].notna() & (data['value'] != '')
+    # Filter and select the key/value columns in a single pass, so the remaining API columns are never copied
+    data = data.loc[mask, ['timestamp', 'point_id', 'point_type', 'value']]
+    timestamps = pd.DatetimeIndex(pd.to_datetime(data['timestamp'], utc=True)).tz_localize(None)
+    # Values are stored as NUMERIC, so they are kept as float64 (float32 would lose significant digits)
+    values = pd.to_numeric(data['value'], errors='coerce').astype(np.float64)
+    return pd.DataFrame({'timestamp': timestamps.to_numpy(),
+                         'point_id': pd.Categorical(data['point_id']),
+                         'point_type': pd.Categorical(data['point_type']),
+                         'value': values.to_numpy()})
+
+
+_INDEX_NAMES = ['timestamp', 'point_id', 'point_type']
+
+
+# Combine the cleaned chunks by concatenating their column arrays and building the MultiIndex once.
+# The categorical codes are used as the index codes directly, so the point labels are never re-hashed.
+def _combine_chunks(chunks: List[pd.DataFrame]) -> pd.DataFrame:
+    ts_codes, ts_levels = pd.factorize(np.concatenate([chunk['timestamp'].to_numpy() for chunk in chunks]))
+    point_ids = union_categoricals([chunk['point_id'] for chunk in chunks])
+    point_types = union_categoricals([chunk['point_type'] for chunk in chunks])
+    index = pd.MultiIndex(levels=[ts_levels, point_ids.categories, point_types.categories],
+                          codes=[ts_codes, point_ids.codes, point_types.codes],
+                          names=_INDEX_NAMES)
+    values = np.concatenate([chunk['value'].to_numpy() for chunk in chunks])
+    return pd.DataFrame({'value': values}, index=index)
 
 
 # ENTSOG assets
-
-@asset(
-    partitions_def=MonthlyPartitionsDefinition(start_date="2016-12-31"),
-    io_manager_key="postgres_io_manager",
-    group_name="entsog",
-    op_tags={"dagster/concurrency_key": "entsog", "concurrency_tag": "entsog"},
-    description="Deliveries / Off-takes (imports for entry points/off-takes per exit points) per day since 2017"
-)
-def entsog_flows_daily(context: AssetExecutionContext):
-    start, end = timewindow_to_ts(context.partition_time_window)
-    context.log.info(f"Handling partition from {start} to {end}")
-
-    keys = entsog_utils.greek_operator_point_directions()
-
-    # Breaking the date range down to avoid timeouts (one request per two days, as daily returns no data)
-    days_list = pd.date_range(start, end, freq='2D')
-
-    bidaily_data = []
-    for day in days_list:
-        data = entsog_utils.entsog_api_call_with_retries(day, day + pd.Timedelta(days=1),
-                                                         ['physical_flow'], keys, context)
-        if data.empty:  # Happens when no matching data is found
-            continue
-        context.log.info(
-            f"Fetched data from {day.strftime('%Y-%m-%d')} to {(day + pd.Timedelta(days=1)).strftime('%Y-%m-%d')}")
-        data = entsog_utils.label_potential_duplicates_with_tso(data)
-        # Rename columns to more applicable names
-        data.rename(columns={"direction_key": "point_type", "period_from": "timestamp", "point_label": "point_id"},
-                    inplace=True)
-        # Set timestamp index and sanitize (to UTC/tz-naive)
-        data['timestamp'] = pd.to_datetime(data['timestamp'], utc=True)
-        data.set_index(pd.DatetimeIndex(data['timestamp']), inplace=True)
-        sanitize_df(data)
-        # Add remaining index columns to form primary key)
-        data.set_index(['point_id', 'point_type'], inplace=True, append=True)
-        # Keep only non-index column
-        data = data[['value']]
-        # Remove rows where 'value' contains an empty string
-        data = data[data['value'] != '']
-        # Remove rows where 'value' contains None
-        data = data[data['value'].notna()]
-        bidaily_data.append(data)
-
-    if len(bidaily_data) == 0:
-        return Output(value=None)
-    else:
-        complete_data = pd.concat(bidaily_data)
-        # For debugging purposes, log the duplicates if present.
-        if not complete_data.index.is_unique:
-            # Find duplicates in the MultiIndex
-            duplicates = complete_data.index.duplicated(keep=False)
-            # Print duplicates based on the MultiIndex
-            context.log.warning(f"Found duplicates in the index! They are as follows:\n{complete_data[duplicates]}")
-
-        return Output(value=complete_data)
-
-
-@asset(
-    partitions_def=MonthlyPartitionsDefinition(start_date="2016-12-31"),
-    io_manager_key="postgres_io_manager",
-    group_name="entsog",
-    op_tags={"dagster/concurrency_key": "entsog", "concurrency_tag": "entsog"},
-    description="Daily nominations for entry and exit points since 2017"
-)
-def entsog_nominations_daily(context: AssetExecutionContext):
-    start, end = timewindow_to_ts(context.partition_time_window)
-    context.log.info(f"Handling partition from {start} to {end}")
-
-    keys = entsog_utils.greek_operator_point_directions()
-
-    # Breaking the date range down to avoid timeouts (one request per two days, as daily returns no data)
-    days_list = pd.date_range(start, end, freq='2D')
-
-    bidaily_data = []
-    for day in days_list:
-        data = entsog_utils.entsog_api_call_with_retries(day, day + pd.Timedelta(days=1), ['nomination'], keys, context)
-        if data.empty:  # Happens when no matching data is found
-            continue
-        context.log.info(
-            f"Fetched data from {day.strftime('%Y-%m-%d')} to {(day + pd.Timedelta(days=1)).strftime('%Y-%m-%d')}")
-        data = entsog_utils.label_potential_duplicates_with_tso(data)
-        # Rename columns to more applicable names
-        data.rename(columns={"direction_key": "point_type", "period_from": "timestamp", "point_label": "point_id"},
-                    inplace=True)
-        # Set timestamp index and sanitize (to UTC/tz-naive)
-        data['timestamp'] = pd.to_datetime(data['timestamp'], utc=True)
-        data.set_index(pd.DatetimeIndex(data['timestamp']), inplace=True)
-        sanitize_df(data)
-        # Add remaining index columns to form primary key)
-        data.set_index(['point_id', 'point_type'], inplace=True, append=True)
-        # Keep only non-index column
-        data = data[['value']]
-        # Remove rows where 'value' contains an empty string
-        data = data[data['value'] != '']
-        # Remove rows where 'value' contains None
-        data = data[data['value'].notna()]
-        bidaily_data.append(data)
-
-    if len(bidaily_data) == 0:
-        return Output(value=None)
-    else:
-        complete_data = pd.concat(bidaily_data)
-        # For debugging purposes, log the duplicates if present.
-        if not complete_data.index.is_unique:
-            # Find duplicates in the MultiIndex
-            duplicates = complete_data.index.duplicated(keep=False)
-            # Print duplicates based on the MultiIndex
-            context.log.warning(f"Found duplicates in the index! They are as follows:\n{complete_data[duplicates]}")
-
-        return Output(value=complete_data)
-
-
-@asset(
-    partitions_def=MonthlyPartitionsDefinition(start_date="2016-12-31"),
-    io_manager_key="postgres_io_manager",
-    group_name="entsog",
-    op_tags={"dagster/concurrency_key": "entsog", "concurrency_tag": "entsog"},
-    description="Daily allocations for entry and exit points since 2017"
-)
-def entsog_allocations_daily(context: AssetExecutionContext):
-    start, end = timewindow_to_ts(context.partition_time_window)
-    context.log.info(f"Handling partition from {start} to {end}")
-
-    keys = entsog_utils.greek_operator_point_directions()
-
-    # Breaking the date range down to avoid timeouts (one request per two days, as daily returns no data)
-    days_list = pd.date_range(start, end, freq='2D')
-
-    bidaily_data = []
-    for day in days_list:
-        data = entsog_utils.entsog_api_call_with_retries(day, day + pd.Timedelta(days=1), ['allocation'], keys, context)
-        if data.empty:  # Happens when no matching data is found
-            continue
-        context.log.info(
-            f"Fetched data from {day.strftime('%Y-%m-%d')} to {(day + pd.Timedelta(days=1)).strftime('%Y-%m-%d')}")
-        data = entsog_utils.label_potential_duplicates_with_tso(data)
-        # Rename columns to more applicable names
-        data.rename(columns={"direction_key": "point_type", "period_from": "timestamp", "point_label": "point_id"},
-                    inplace=True)
-        # Set timestamp index and sanitize (to UTC/tz-naive)
-        data['timestamp'] = pd.to_datetime(data['timestamp'], utc=True)
-        data.set_index(pd.DatetimeIndex(data['timestamp']), inplace=True)
-        sanitize_df(data)
-        # Add remaining index columns to form primary key)
-        data.set_index(['point_id', 'point_type'], inplace=True, append=True)
-        # Keep only non-index column
-        data = data[['value']]
-        # Remove rows where 'value' contains an empty string
-        data = data[data['value'] != '']
-        # Remove rows where 'value' contains None
-        data = data[data['value'].notna()]
-        bidaily_data.append(data)
-
-    if len(bidaily_data) == 0:
-        return Output(value=None)
-    else:
-        complete_data = pd.concat(bidaily_data)
-        # For debugging purposes, log the duplicates if present.
-        if not complete_data.index.is_unique:
-            # Find duplicates in the MultiIndex
-            duplicates = complete_data.index.duplicated(keep=False)
-            # Print duplicates based on the MultiIndex
-            context.log.warning(f"Found duplicates in the index! They are as follows:\n{complete_data[duplicates]}")
-
-        return Output(value=complete_data)
-
-
-@asset(
-    partitions_def=MonthlyPartitionsDefinition(start_date="2016-12-31"),
-    io_manager_key="postgres_io_manager",
-    group_name="entsog",
-    op_tags={"dagster/concurrency_key": "entsog", "concurrency_tag": "entsog"},
-    description="Daily renominations for entry and exit points since 2017"
-)
-def entsog_renominations_daily(context: AssetExecutionContext):
-    start, end = timewindow_to_ts(context.partition_time_window)
-    context.log.info(f"Handling partition from {start} to {end}")
-
-    keys = entsog_utils.greek_operator_point_directions()
-
-    # Breaking the date range down to avoid timeouts (one request per two days, as daily returns no data)
-    days_list = pd.date_range(start, end, freq='2D')
-
-    bidaily_data = []
-    for day in days_list:
-        data = entsog_utils.entsog_api_call_with_retries(day, day + pd.Timedelta(days=1),
-                                                         ['renomination'], keys, context)
-        if data.empty:  # Happens when no matching data is found
-            continue
-        context.log.info(
-            f"Fetched data from {day.strftime('%Y-%m-%d')} to {(day + pd.Timedelta(days=1)).strftime('%Y-%m-%d')}")
-        data = entsog_utils.label_potential_duplicates_with_tso(data)
-        # Rename columns to more applicable names
-        data.rename(columns={"direction_key": "point_type", "period_from": "timestamp", "point_label": "point_id"},
-                    inplace=True)
-        # Set timestamp index and sanitize (to UTC/tz-naive)
-        data['timestamp'] = pd.to_datetime(data['timestamp'], utc=True)
-        data.set_index(pd.DatetimeIndex(data['timestamp']), inplace=True)
-        sanitize_df(data)
-        # Add remaining index columns to form primary key)
-        data.set_index(['point_id', 'point_type'], inplace=True, append=True)
-        # Keep only non-index column
-        data = data[['value']]
-        # Remove rows where 'value' contains an empty string
-        data = data[data['value'] != '']
-        # Remove rows where 'value' contains None
-        data = data[data['value'].notna()]
-        bidaily_data.append(data)
-
-    if len(bidaily_data) == 0:
-        return Output(value=None)
-    else:
-        complete_data = pd.concat(bidaily_data)
-        # For debugging purposes, log the duplicates if present.
-        if not complete_data.index.is_unique:
-            # Find duplicates in the MultiIndex
-            duplicates = complete_data.index.duplicated(keep=False)
-            # Print duplicates based on the MultiIndex
-            context.log.warning(f"Found duplicates in the index! They are as follows:\n{complete_data[duplicates]}")
-
-        return Output(value=complete_data)
+# The daily ENTSOG assets only differ in the queried indicator, so they are generated by a single factory
+
+def _make_entsog_daily_asset(name: str, indicator: str, description: str):
+    @asset(
+        name=name,
+        partitions_def=MonthlyPartitionsDefinition(start_date="2016-12-31"),
+        io_manager_key="postgres_io_manager",
+        group_name="entsog",
+        op_tags={"dagster/concurrency_key": "entsog", "concurrency_tag": "entsog"},
+        description=description
+    )
+    def _entsog_daily_asset(context: AssetExecutionContext):
+        start, end = timewindow_to_ts(context.partition_time_window)
+        context.log.info(f"Handling partition from {start} to {end}")
+
+        keys = entsog_utils.greek_operator_point_directions()
+
+        # Breaking the date range down to avoid timeouts (one request per week, split further on failure)
+        window_starts = pd.date_range(start, end, freq=f'{_WINDOW_DAYS}D', inclusive='left')
+
+        def fetch(window_start: pd.Timestamp) -> List[pd.DataFrame]:
+            window_end = min(window_start + pd.Timedelta(days=_WINDOW_DAYS - 1), end)
+            return _fetch_window(window_start, window_end, indicator, keys, context)
+
+        # Fetch the windows concurrently, the requests are network-bound (results keep the order of window_starts)
+        with ThreadPoolExecutor(max_workers=_MAX_WORKERS) as executor:
+            chunks = [chunk for window_chunks in executor.map(fetch, window_starts) for chunk in window_chunks]
+
+        if len(chunks) == 0:
+            return Output(value=None)
+        else:
+            complete_data = _combine_chunks(chunks)
+            # For debugging purposes, log the duplicates if present.
+            if not complete_data.index.is_unique:
+                # Count the occurrences of each index entry instead of masking and slicing the whole frame
+                counts = complete_data.index.value_counts()
+                duplicates = counts[counts > 1]
+                # Print duplicated index entries along with their number of occurrences
+                context.log.warning(
+                    f"Found {len(duplicates)} duplicates in the index! They are as follows:\n{duplicates}")
+
+            return Output(value=complete_data)
+
+    return _entsog_daily_asset
+
+
+entsog_flows_daily = _make_entsog_daily_asset(
+    "entsog_flows_daily", "physical_flow",
+    "Deliveries / Off-takes (imports for entry points/off-takes per exit points) per day since 2017")
+
+entsog_nominations_daily = _make_entsog_daily_asset(
+    "entsog_nominations_daily", "nomination", "Daily nominations for entry and exit points since 2017")
+
+entsog_allocations_daily = _make_entsog_daily_asset(
+    "entsog_allocations_daily", "allocation", "Daily allocations for entry and exit points since 2017")
+
+entsog_renominations_daily = _make_entsog_daily_asset(
+    "entsog_renominations_daily", "renomination", "Daily renominations for entry and exit points since 2017")
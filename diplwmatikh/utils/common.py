@@ -1,10 +1,13 @@
-from typing import List, Tuple
+from typing import List, Tuple, Union
 
 import pandas as pd
 import numpy as np
 import pytz
+import requests
 from dagster import TimeWindow
 from pandas import Timestamp
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 
 
 # make timestamp UTC and tz-naive
@@ -32,11 +35,27 @@ def timewindow_to_ts(tw: TimeWindow) -> (Timestamp, Timestamp):
     return start, end
 
 
-def replace_dash_with_nan(cell):
-    if isinstance(cell, str) and cell.strip() == "-":
-        return np.nan
-    else:
-        return cell
+# build a requests session with pooled keep-alive connections, so that repeated calls to the same host reuse
+# TCP/TLS connections. `max_retries` are transport-level retries; pass 0 when the caller already retries.
+def http_session(pool_connections: int = 10, pool_maxsize: int = 20,
+                 max_retries: Union[Retry, int] = Retry(total=5, backoff_factor=0.3)) -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_connections,
+                          pool_maxsize=pool_maxsize,
+                          max_retries=max_retries)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update({"User-Agent": "diplwmatikh", "Accept-Encoding": "gzip"})
+    return session
+
+
+# Cells holding only a dash (hyphen, en or em dash) denote missing values in the source files
+_DASH_PATTERN = r"^\s*[-\u2013\u2014]\s*$"
+
+
+# replace dash-only cells with NaN in a single vectorized pass, then re-infer column dtypes
+def replace_dash_with_nan(obj: Union[pd.DataFrame, pd.Series]) -> Union[pd.DataFrame, pd.Series]:
+    return obj.replace(to_replace=_DASH_PATTERN, value=np.nan, regex=True).infer_objects()
 
 def find_string_in_df_by_index(df, search_string, case_sensitive=False) -> List[Tuple[int, int]]:
     """
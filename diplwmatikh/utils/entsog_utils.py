@@ -1,6 +1,6 @@
-from typing import List
+import functools
+from typing import List, Optional
 
-import entsog
 import pandas as pd
 import time
 
@@ -8,10 +8,28 @@ from dagster import AssetExecutionContext
 from entsog import EntsogPandasClient
 from entsog.exceptions import NoMatchingDataError
 
+from .common import http_session
+
 # Dictionary that matches TSO EIC codes to TSO names
 tso_dict = {"21X-GR-A-A0A0A-G": "DESFA",
             "21X000000001376X": "TAP"}
 
+# Shared session for all ENTSOG API calls (connection reuse across requests).
+# Its connection pool is thread-safe, so it is also shared by concurrent fetches.
+# No transport-level retries: entsog-py already retries connection errors and so does entsog_api_call_with_retries.
+_SESSION = http_session(max_retries=0)
+# Read timeout (seconds) of an ENTSOG API request, i.e. the longest the server may stay silent before the request
+# is abandoned. Kept generous, since slow (but progressing) queries used to run without any timeout.
+_TIMEOUT = 300
+
+
+# EntsogPandasClient takes no constructor arguments, so the shared session and the timeout are set afterwards
+def entsog_client(timeout: Optional[float] = _TIMEOUT) -> EntsogPandasClient:
+    client = EntsogPandasClient()
+    client.session = _SESSION
+    client.timeout = timeout
+    return client
+
 
 # Some points can belong of different TSOs (e.g. both DESFA and TAP have Nea Mesimvria as a point)
 # The below function preemptively labels these points by adding their TSO as a suffix, to avoid deduplication
@@ -28,8 +46,12 @@ def label_potential_duplicates_with_tso(df: pd.DataFrame) -> pd.DataFrame:
     return df
 
 
+# The operator point directions are static, so they are fetched once per process. With the multiprocess executor
+# each step runs in its own process, so this only saves repeated lookups within a step process (or across steps
+# when they share a process, e.g. with the in-process executor), not across separate steps or runs.
+@functools.cache
 def greek_operator_point_directions():
-    points = entsog.EntsogPandasClient().query_operator_point_directions()
+    points = entsog_client().query_operator_point_directions()
     mask1 = points['t_so_balancing_zone'].str.contains('Greece')
     mask2 = points['t_so_country'].str == 'GR'
     masked_points = points[mask1 | mask2]
@@ -47,15 +69,16 @@ def entsog_api_call_with_retries(start: pd.Timestamp,
                                  keys: List[str],
                                  context: AssetExecutionContext,
                                  max_retries: int = 10,
-                                 delay_seconds: int = 1) -> pd.DataFrame:
+                                 delay_seconds: int = 1,
+                                 timeout: Optional[float] = _TIMEOUT) -> pd.DataFrame:
     last_exception = None
     for attempt in range(max_retries):
         try:
-            data = EntsogPandasClient().query_operational_point_data(start=start,
-                                                                     end=end,
-                                                                     indicators=indicators,
-                                                                     point_directions=keys,
-                                                                     verbose=False)
+            data = entsog_client(timeout).query_operational_point_data(start=start,
+                                                                       end=end,
+                                                                       indicators=indicators,
+                                                                       point_directions=keys,
+                                                                       verbose=False)
             if attempt > 0:
                 context.log.info(f"Attempt no {attempt + 1} successful.")
             return data
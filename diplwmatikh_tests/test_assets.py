@@ -1 +1,120 @@
+import os
+from unittest import mock
 
+import numpy as np
+import pandas as pd
+import pytest
+import requests
+from dagster import build_asset_context
+
+from diplwmatikh.assets import desfa, entsog
+from diplwmatikh.utils import entsog_utils
+
+
+def test_entsog_client_sends_requests_through_shared_session():
+    with mock.patch.object(entsog_utils._SESSION, "get", side_effect=RuntimeError("request sent")) as get:
+        with pytest.raises(RuntimeError, match="request sent"):
+            entsog_utils.entsog_client().query_operator_point_directions()
+    assert get.call_args.kwargs["timeout"] == entsog_utils._TIMEOUT
+
+
+# Stands in for entsog_api_call_with_retries: windows longer than `max_days` time out, the others return
+# one row per day. The requested windows are recorded in `calls`.
+def _fake_api_call(calls, max_days):
+    def api_call(start, end, indicators, keys, context, **kwargs):
+        calls.append((start, end))
+        if (end - start).days + 1 > max_days:
+            raise requests.Timeout("window too large")
+        days = pd.date_range(start, end, freq='D', tz='UTC')
+        return pd.DataFrame({"period_from": days.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                             "point_label": "Kipi",
+                             "direction_key": "entry",
+                             "tso_eic_code": "21X-GR-A-A0A0A-G",
+                             "value": "1.5"})
+    return api_call
+
+
+def test_entsog_timed_out_windows_are_split_and_cover_every_day():
+    calls = []
+    with mock.patch.object(entsog_utils, "greek_operator_point_directions", return_value=["key"]), \
+            mock.patch.object(entsog_utils, "entsog_api_call_with_retries", _fake_api_call(calls, max_days=3)):
+        output = entsog.entsog_flows_daily(build_asset_context(partition_key="2024-02-01"))
+
+    # Every day from the partition start to its end is fetched by exactly one successful request,
+    # with the last window clipped to the partition end
+    fetched_days = [day for start, end in calls if (end - start).days + 1 <= 3
+                    for day in pd.date_range(start, end, freq='D')]
+    expected_days = pd.date_range("2024-02-01", "2024-03-01", freq='D', tz='UTC')
+    assert sorted(fetched_days) == list(expected_days)
+    assert max(end for _, end in calls) == expected_days[-1]
+
+    timestamps = output.value.index.get_level_values('timestamp')
+    assert list(timestamps.unique().sort_values()) == list(expected_days.tz_localize(None))
+
+
+def test_entsog_other_errors_are_not_split():
+    context = mock.Mock()
+    with mock.patch.object(entsog_utils, "entsog_api_call_with_retries", side_effect=ValueError("bad key")) as call:
+        with pytest.raises(ValueError, match="bad key"):
+            entsog._fetch_window(pd.Timestamp("2024-02-01"), pd.Timestamp("2024-02-07"), "physical_flow", ["key"],
+                                 context)
+    assert call.call_count == 1
+
+
+def test_entsog_combined_chunks_index():
+    def chunk(day, point_ids, point_types, values):
+        return pd.DataFrame({'timestamp': pd.DatetimeIndex([day] * len(values)).to_numpy(),
+                             'point_id': pd.Categorical(point_ids),
+                             'point_type': pd.Categorical(point_types),
+                             'value': np.array(values, dtype=np.float64)})
+
+    combined = entsog._combine_chunks([chunk("2024-02-01", ["Kipi", "Sidirokastro"], ["entry", "entry"], [1.0, 2.0]),
+                                       chunk("2024-02-03", ["Agia Triada", "Kipi"], ["exit", "entry"], [3.0, 4.0])])
+
+    assert combined.index.names == ['timestamp', 'point_id', 'point_type']
+    assert combined.index.tolist() == [(pd.Timestamp("2024-02-01"), "Kipi", "entry"),
+                                       (pd.Timestamp("2024-02-01"), "Sidirokastro", "entry"),
+                                       (pd.Timestamp("2024-02-03"), "Agia Triada", "exit"),
+                                       (pd.Timestamp("2024-02-03"), "Kipi", "entry")]
+    assert combined['value'].tolist() == [1.0, 2.0, 3.0, 4.0]
+
+
+def test_desfa_wide_to_long_labels_bidirectional_point_as_entry_and_exit():
+    # The first row holds the point names, SIDIROKASTRO is both an entry (2nd column) and an exit (last column)
+    wide = pd.DataFrame([[None, "AGIA TRIADA", "SIDIROKASTRO", "EXIT A", "SIDIROKASTRO"],
+                         [pd.Timestamp("2024-01-01"), 1, 2, 3, 4],
+                         [pd.Timestamp("2024-01-02"), 5, 6, 7, 8]])
+
+    long = desfa._points_wide_to_long(wide, n_entry=2)
+
+    assert long.index.names == ['timestamp', 'point_id', 'point_type']
+    sidirokastro = long.xs("SIDIROKASTRO", level='point_id')['value']
+    assert sidirokastro.to_dict() == {(pd.Timestamp("2024-01-01"), "entry"): 2,
+                                      (pd.Timestamp("2024-01-01"), "exit"): 4,
+                                      (pd.Timestamp("2024-01-02"), "entry"): 6,
+                                      (pd.Timestamp("2024-01-02"), "exit"): 8}
+    assert long.xs("EXIT A", level='point_id').index.get_level_values('point_type').unique().tolist() == ["exit"]
+
+
+def test_desfa_unchanged_file_is_served_from_cache(tmp_path):
+    cache_dir = tmp_path / "desfa_cache"
+    os.makedirs(cache_dir, mode=0o700)
+    url = "https://www.desfa.gr/userfiles/pdflist/DDRA/Flows.xlsx"
+    parsed = pd.DataFrame({'value': [1.0, 2.0]},
+                          index=pd.MultiIndex.from_tuples([(pd.Timestamp("2024-01-01"), "KIPI", "entry"),
+                                                           (pd.Timestamp("2024-01-01"), "KIPI", "exit")],
+                                                          names=['timestamp', 'point_id', 'point_type']))
+    ok = mock.Mock(status_code=200, headers={"ETag": '"v1"'})
+    not_modified = mock.Mock(status_code=304, headers={"ETag": '"v1"'})
+
+    with mock.patch.object(desfa, "_CACHE_DIR", str(cache_dir)), \
+            mock.patch.object(desfa._SESSION, "get", side_effect=[ok, not_modified]) as get:
+        cached, response = desfa._conditional_get(url, timeout=60)
+        assert cached is None and response is ok
+        desfa._update_cache(url, response, parsed)
+
+        cached, response = desfa._conditional_get(url, timeout=60)
+
+    assert get.call_args.kwargs["headers"] == {"If-None-Match": '"v1"'}
+    assert response is not_modified
+    pd.testing.assert_frame_equal(cached, parsed)